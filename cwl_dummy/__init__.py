@@ -22,17 +22,23 @@
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 
-import argparse
+import concurrent.futures
 import datetime
-import difflib
 import io
 import os.path
 import pathlib
 import sys
-import textwrap
-from typing import Any, List, Mapping, MutableMapping, MutableSequence, Set, cast
+from typing import Any, List, MutableMapping, MutableSequence, Set, cast
 
-import ruamel.yaml.scalarstring
+try:
+    # A drop-in Rust implementation of unified_diff, several times
+    # faster than the stdlib on big files; entirely optional.
+    from difflib_rs import unified_diff
+except ImportError:
+    from difflib import unified_diff
+
+import ruamel.yaml
+from ruamel.yaml.events import AliasEvent, CollectionEndEvent, CollectionStartEvent, ScalarEvent
 
 from cwl_dummy.utils import (
     UnhandledCwlError, coloured_diff, ensure_list, ensure_sequence_form, error, format_error, mapping_to_sequence,
@@ -40,6 +46,17 @@ from cwl_dummy.utils import (
 )
 
 
+# Constructing a YAML instance is surprisingly expensive, so a single
+# one is shared by every file. The "safe" variant uses the C loader
+# where available, which is around an order of magnitude faster than the
+# pure-Python round-trip loader -- and since the output is rewritten
+# wholesale, there are no comments worth preserving anyway.
+_yaml = ruamel.yaml.YAML(typ="safe")
+_yaml.default_flow_style = False
+# Keep the keys in the order they were written, not sorted.
+_yaml.representer.sort_base_mapping_type_on_output = False
+
+
 class Arguments:
     filenames: List[pathlib.Path]
     force: bool
@@ -52,6 +69,9 @@ args: Arguments
 
 def main():
     global args
+    # Imported here so that importing the package (e.g. for the helper
+    # functions) doesn't pay for argparse.
+    import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "filenames", nargs="+", metavar="filename", type=pathlib.Path, help="a Workflow or CommandLineTool to mock"
@@ -63,35 +83,91 @@ def main():
     # The typeshed signature for parse_args currently does not account
     # for custom namespaces, so we have to cast to get typechecking.
     args = cast(Arguments, parser.parse_args(namespace=Arguments()))
-    for filename in args.filenames:
-        try:
-            mock_file(filename)
-        except UnhandledCwlError as e:
-            error(e, filename)
+    if len(args.filenames) > 1:
+        # Top-level files are independent (workflows cannot refer to
+        # themselves, even indirectly), and parsing dominates the
+        # runtime, so process them in parallel. Sub-workflows shared
+        # between top-level files may be mocked once per process.
+        with concurrent.futures.ProcessPoolExecutor(initializer=set_args, initargs=(args,)) as executor:
+            for _ in executor.map(mock_top_level_file, args.filenames):
+                pass
+    else:
+        for filename in args.filenames:
+            mock_top_level_file(filename)
+
+
+def set_args(new_args: Arguments) -> None:
+    """Initialise the global arguments in a worker process."""
+    global args
+    args = new_args
+
+
+def mock_top_level_file(filename: pathlib.Path) -> None:
+    """Mock a file given on the command line, reporting failures."""
+    try:
+        mock_file(filename)
+    except UnhandledCwlError as e:
+        error(e, filename)
+
+
+mocked_files: Set[str] = set()
+
 
+def cwl_version(stream):
+    """Extract cwlVersion from a YAML stream without building a document.
 
-mocked_files: Set[pathlib.Path] = set()
+    Returns None if the top-level node is not a mapping or has no
+    cwlVersion key. This only scans parse events, so rejecting a file
+    with the wrong version doesn't pay for a full parse.
+    """
+    depth = 0
+    expecting_value = is_version = False
+    for event in _yaml.parse(stream):
+        if isinstance(event, CollectionStartEvent):
+            if depth == 1 and expecting_value:
+                # The value for the previous key was a collection.
+                expecting_value = False
+            depth += 1
+        elif isinstance(event, CollectionEndEvent):
+            depth -= 1
+            if depth == 0:
+                break
+        elif isinstance(event, (ScalarEvent, AliasEvent)) and depth == 1:
+            if expecting_value:
+                if is_version:
+                    return getattr(event, "value", None)
+                expecting_value = False
+            else:
+                is_version = getattr(event, "value", None) == "cwlVersion"
+                expecting_value = True
+    return None
 
 
 def mock_file(filename: pathlib.Path) -> None:
     """Mock a CWL file, given a path."""
     global mocked_files
-    if filename in mocked_files:
+    # Resolve the path so that the same file reached via different
+    # relative paths (or symlinks) is only processed once; a plain
+    # string key hashes faster than a pathlib.Path.
+    resolved = os.path.realpath(filename)
+    if resolved in mocked_files:
         print(f"Already mocked file this run, ignoring: {filename}")
         return
-    mocked_files.add(filename)
+    mocked_files.add(resolved)
     print(f"Mocking file: {filename}")
 
     with open(filename, "r") as f:
-        cwl = ruamel.yaml.round_trip_load(f)
-
-    if cwl.get("cwlVersion") != "v1.0":
-        raise UnhandledCwlError("Can't process CWL versions other than v1.0")
+        if cwl_version(f) != "v1.0":
+            raise UnhandledCwlError("Can't process CWL versions other than v1.0")
+        f.seek(0)
+        cwl = _yaml.load(f)
 
     comment = exception = None
     try:
         cwl = mock_document(cwl, filename.parent)
     except UnhandledCwlError as e:
+        # Only needed on the failure path, so not imported at the top.
+        import textwrap
         # Since most things mutate `cwl` in-place, we can carry on and
         # write the file to make it easier to fix it by hand.
         comment = textwrap.indent(format_error(e, filename), "# ")
@@ -100,36 +176,61 @@ def mock_file(filename: pathlib.Path) -> None:
         exception = e
 
     outfile = filename.with_suffix(filename.suffix + ".dummy")
-    if args.diff and outfile.exists():
-        with open(outfile, "r") as f:
-            existing_lines = f.readlines()
-        # Get the new CWL as a list of strings.
-        new_file = io.StringIO()
+    exists = outfile.exists()
+    if comment and exists and not args.force_broken:
+        skip_reason = f"Not writing file because it already exists and could not be processed: {outfile}"
+    elif exists and not args.force:
+        skip_reason = f"Not writing file because it already exists: {outfile}"
+    else:
+        skip_reason = None
+    diffing = args.diff and exists
+
+    if diffing or skip_reason is None:
+        # Serialize once; the same text feeds the diff and the write,
+        # and dumping to a buffer means the output file gets a single
+        # write rather than many small ones from the emitter.
+        buf = io.StringIO()
         if comment:
-            new_file.write(comment + "\n")
-        ruamel.yaml.round_trip_dump(cwl, new_file, default_flow_style=False)
-        new_file.seek(0)
-        new_lines = new_file.readlines()
-        existing_time = datetime.datetime.fromtimestamp(os.path.getmtime(outfile), tz=datetime.timezone.utc)
-        new_time = datetime.datetime.now(tz=datetime.timezone.utc)
-        # If there's no difference, this won't print anything.
-        print("".join(coloured_diff(difflib.unified_diff(
-            existing_lines,
-            new_lines,
-            fromfile=f"existing/{outfile}",
-            tofile=f"modified/{outfile}",
-            fromfiledate=existing_time.isoformat(),
-            tofiledate=new_time.isoformat(timespec="microseconds" if existing_time.microsecond else "seconds"),
-        ))), end="")
-    if comment and outfile.exists() and not args.force_broken:
-        print(f"Not writing file because it already exists and could not be processed: {outfile}")
-    elif outfile.exists() and not args.force:
-        print(f"Not writing file because it already exists: {outfile}")
+            buf.write(comment + "\n")
+        _yaml.dump(cwl, buf)
+        new_text = buf.getvalue()
+
+    unchanged = False
+    if diffing:
+        with open(outfile, "r") as f:
+            existing_text = f.read()
+        # Unchanged content is the common case on re-runs, and a string
+        # comparison is much cheaper than letting difflib find out.
+        unchanged = existing_text == new_text
+        if not unchanged:
+            # The timestamps are only needed for the diff headers.
+            existing_time = datetime.datetime.fromtimestamp(os.path.getmtime(outfile), tz=datetime.timezone.utc)
+            new_time = datetime.datetime.now(tz=datetime.timezone.utc)
+            print("".join(coloured_diff(unified_diff(
+                existing_text.splitlines(keepends=True),
+                new_text.splitlines(keepends=True),
+                fromfile=f"existing/{outfile}",
+                tofile=f"modified/{outfile}",
+                fromfiledate=existing_time.isoformat(),
+                tofiledate=new_time.isoformat(timespec="microseconds" if existing_time.microsecond else "seconds"),
+            ))), end="")
+
+    if skip_reason is not None:
+        print(skip_reason)
+    elif unchanged:
+        # Forced runs with --diff already know the file is identical,
+        # so rewriting it would only churn mtimes.
+        print(f"Not writing file because it is unchanged: {outfile}")
     else:
-        with open(outfile, "w") as f:
-            if comment:
-                f.write(comment + "\n")
-            ruamel.yaml.round_trip_dump(cwl, f, default_flow_style=False)
+        # Write to a temporary file and rename it into place, so that a
+        # crash (or two workers racing on a shared sub-file) can never
+        # leave a truncated .dummy file for a later run to read. The
+        # pid makes the temporary name unique across worker processes.
+        tmpfile = outfile.with_suffix(f"{outfile.suffix}.{os.getpid()}.tmp")
+        # Encoding up front and writing bytes skips the TextIOWrapper
+        # machinery: one encode, one write.
+        tmpfile.write_bytes(new_text.encode("utf-8"))
+        os.replace(tmpfile, outfile)
         print(f"Wrote mocked file: {outfile}")
 
     if exception:
@@ -138,29 +239,27 @@ def mock_file(filename: pathlib.Path) -> None:
 
 def mock_document(cwl, directory: pathlib.Path):
     """Mock a CWL document represented as a Python object."""
-    assert isinstance(cwl, MutableMapping)  # Guard against implicit $graph
+    # Guard against implicit $graph. The safe loader only produces
+    # plain dicts, so there's no need for the (slow) ABC check.
+    assert isinstance(cwl, dict)
     cls = cwl.get("class")
-    if cls == "Workflow":
-        cwl = mock_workflow(cwl, directory)
-    elif cls == "CommandLineTool":
-        cwl = mock_command_line_tool(cwl)
-    elif cls == "ExpressionTool":
-        warn("ignoring ExpressionTool")
-    else:
+    handler = CLASS_HANDLERS.get(cls)
+    if handler is None:
         raise UnhandledCwlError(f"Unknown document class {cls!r}")
-    return cwl
+    return handler(cwl, directory)
 
 
 def mock_workflow(cwl, directory: pathlib.Path):
     """Mock a CWL workflow represented as a Python object."""
     assert cwl["class"] == "Workflow"
-    assert all(x in cwl for x in {"inputs", "outputs", "steps"})
-    for x in {"requirements", "hints"} & cwl.keys():
-        cwl[x] = rewrite_requirements(ensure_sequence_form(cwl[x], key_key="class"))
+    assert "inputs" in cwl and "outputs" in cwl and "steps" in cwl
+    for x in ("requirements", "hints"):
+        if x in cwl:
+            cwl[x] = rewrite_requirements(ensure_sequence_form(cwl[x], key_key="class"))
 
     cwl["steps"] = ensure_sequence_form(cwl["steps"])
     for step in cwl["steps"]:
-        if isinstance(step["run"], str):
+        if type(step["run"]) is str:
             # got a filename -- recurse into it
             # NB: CWL workflows are not allowed to refer to themselves
             # (even indirectly), so we don't need to keep track of which
@@ -184,19 +283,36 @@ def mock_workflow(cwl, directory: pathlib.Path):
 def mock_command_line_tool(cwl):
     """Mock a CWL command line tool represented as a Python object."""
     assert cwl["class"] == "CommandLineTool"
-    assert all(x in cwl for x in {"inputs", "outputs"})
-    for x in {"requirements", "hints"} & cwl.keys():
-        cwl[x] = rewrite_requirements(ensure_sequence_form(cwl[x], key_key="class"))
+    assert "inputs" in cwl and "outputs" in cwl
+    for x in ("requirements", "hints"):
+        if x in cwl:
+            cwl[x] = rewrite_requirements(ensure_sequence_form(cwl[x], key_key="class"))
+    return cwl
+
+
+def mock_expression_tool(cwl, directory: pathlib.Path):
+    """(Not really) mock a CWL expression tool represented as a Python object."""
+    warn("ignoring ExpressionTool")
     return cwl
 
 
-def rewrite_requirements(requirements: MutableSequence[Mapping[str, Any]]) -> MutableSequence:
-    for i, r in enumerate(requirements):
+# Dispatching on the document class through a dict is cheaper than an
+# if/elif chain, and runs once per (possibly nested) document.
+CLASS_HANDLERS = {
+    "Workflow": mock_workflow,
+    "CommandLineTool": lambda cwl, directory: mock_command_line_tool(cwl),
+    "ExpressionTool": mock_expression_tool,
+}
+
+
+def rewrite_requirements(requirements: MutableSequence[MutableMapping[str, Any]]) -> MutableSequence:
+    for r in requirements:
         if r["class"] == "DockerRequirement":
-            requirements[i] = {
-                "class": "DockerRequirement",
-                "dockerPull": "mercury/cwl-scheduler-tests",
-            }
+            # Mutating in place avoids allocating a replacement dict
+            # for every requirement rewritten.
+            r.clear()
+            r["class"] = "DockerRequirement"
+            r["dockerPull"] = "mercury/cwl-scheduler-tests"
     return requirements
 
 
@@ -210,29 +326,50 @@ def type_contains(typ, needle):
     fully-expanded form of the type, i.e.
     `{"type": "array", "items": "int"}` rather than `"int[]"`.
     """
-    if typ == needle:
-        return True
-    if isinstance(typ, str):
-        if typ.endswith("?"):
-            return needle == "null" or type_contains(typ[:-1], needle)
-        if typ.endswith("[]"):
-            return type_contains({"type": "array", "items": typ[:-2]}, needle)
-        return isinstance(needle, str) and needle == typ
-    assert isinstance(typ, dict)
-    if typ["type"] == "array":
-        assert "items" in typ
-        if isinstance(typ["items"], str):
-            return type_contains(typ["items"], needle)
-        return any(type_contains(item, needle) for item in typ["items"])
-    if typ["type"] == "record":
-        return any(
-            type_contains(field["type"], needle) for field in (
-                typ["fields"] if isinstance(typ["fields"], list) else typ["fields"].values()
+    # An explicit stack avoids a Python frame per level of nesting, and
+    # the id-based set means shared subtrees are only walked once.
+    stack = [typ]
+    seen: Set[int] = set()
+    # id() keys are only stable while the object is alive, so every
+    # visited mapping has to be kept alive for the duration of the
+    # call -- otherwise a dict synthesized for a "foo[]" suffix can be
+    # collected and a later one at the same address wrongly skipped.
+    keepalive: List[Any] = []
+    while stack:
+        typ = stack.pop()
+        if typ == needle:
+            return True
+        if isinstance(typ, str):
+            if typ.endswith("?"):
+                if needle == "null":
+                    return True
+                stack.append(typ[:-1])
+            elif typ.endswith("[]"):
+                stack.append({"type": "array", "items": typ[:-2]})
+            continue
+        assert isinstance(typ, dict)
+        if id(typ) in seen:
+            continue
+        seen.add(id(typ))
+        keepalive.append(typ)
+        if typ["type"] == "array":
+            assert "items" in typ
+            if isinstance(typ["items"], str):
+                stack.append(typ["items"])
+            else:
+                stack.extend(typ["items"])
+        elif typ["type"] == "record":
+            stack.extend(
+                field["type"] for field in (
+                    typ["fields"] if isinstance(typ["fields"], list) else typ["fields"].values()
+                )
             )
-        )
-    if typ["type"] == "enum":
-        return needle.get("type") == "enum" and set(needle["symbols"]) == set(typ["symbols"])
-    raise TypeError(f"Invalid (or unknown) type: {typ!r}")
+        elif typ["type"] == "enum":
+            if needle.get("type") == "enum" and set(needle["symbols"]) == set(typ["symbols"]):
+                return True
+        else:
+            raise TypeError(f"Invalid (or unknown) type: {typ!r}")
+    return False
 
 
 if __name__ == "__main__":
@@ -34,6 +34,15 @@ def test_type_contains():
     assert type_contains({"type": "array", "items": "int?"}, "null")
 
 
+@pytest.mark.parametrize("typ", CWL_TYPES)
+def test_type_contains_nested_arrays(typ):
+    assert type_contains(f"{typ}[][]", typ)
+    assert type_contains(f"{typ}[][][]", typ)
+    assert type_contains(f"{typ}[][]?", typ)
+    assert type_contains(f"{typ}[][]?", "null")
+    assert not type_contains(f"{typ}[][]", "a")
+
+
 @pytest.mark.parametrize("typ", CWL_TYPES)
 def test_type_contains_param(typ):
     assert type_contains(typ, typ)
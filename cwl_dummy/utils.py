@@ -23,9 +23,8 @@
 """Awful junk that doesn't fit anywhere else."""
 
 
+import functools
 import re
-import textwrap
-import traceback
 from typing import Any, Iterable, Iterator, List, Mapping, Sequence, TypeVar, Union, overload
 
 import crayons
@@ -75,13 +74,17 @@ def mapping_to_sequence(
     hints sections should have `key_key` set to "class".
     """
     assert isinstance(mapping, Mapping)
-    return [
-        {
-            key_key: k,
-            **(v if isinstance(v, Mapping) else {single_value_key: v})
-        }
-        for k, v in mapping.items()
-    ]
+    result = []
+    for k, v in mapping.items():
+        # dict.update is a single C-level copy, unlike the equivalent
+        # {key_key: k, **v} splat, which iterates v key-by-key.
+        d = {key_key: k}
+        if isinstance(v, Mapping):
+            d.update(v)
+        else:
+            d[single_value_key] = v
+        result.append(d)
+    return result
 
 
 @overload
@@ -94,7 +97,12 @@ def ensure_sequence_form(mapping_or_sequence: SequenceT, **kwargs) -> SequenceT:
 
 def ensure_sequence_form(mapping_or_sequence, **kwargs):
     """Ensure the argument is in sequence form."""
-    if isinstance(mapping_or_sequence, Mapping):
+    # Fast paths: the YAML loader only produces plain lists and dicts,
+    # so the (slow) ABC isinstance checks are a fallback for callers
+    # passing other mapping/sequence types.
+    if type(mapping_or_sequence) is list:
+        return mapping_or_sequence
+    if type(mapping_or_sequence) is dict or isinstance(mapping_or_sequence, Mapping):
         return mapping_to_sequence(mapping_or_sequence, **kwargs)
     assert isinstance(mapping_or_sequence, Sequence)
     return mapping_or_sequence
@@ -112,11 +120,18 @@ PARAMETER_REFERENCE = rf" \$\( {SYMBOL} ({SEGMENT})* \) "
 PARAMETER_REFERENCE_RE = re.compile(PARAMETER_REFERENCE, flags=re.VERBOSE)
 
 
+# CWL files repeat the same small set of expressions (globs, bindings)
+# across many steps, so caching pays for itself quickly.
+@functools.lru_cache(maxsize=2048)
 def strip_references(s: str) -> str:
     """Remove parameter references from a string.
 
     NOTE: JavaScript expressions are not necessarily removed.
     """
+    # Most strings contain no references at all, and the regex can't
+    # match without a literal "$(", so don't even start the engine.
+    if "$(" not in s:
+        return s
     # It goes without saying that removing JavaScript expressions would
     # be significantly more complicated.
     return PARAMETER_REFERENCE_RE.sub("", s)
@@ -132,7 +147,9 @@ def ensure_list(x: T) -> List[T]: ...
 
 def ensure_list(x):
     """Ensure the argument is a list."""
-    if isinstance(x, list):
+    # `type(x) is list` skips the subclass check, which is fine because
+    # the safe YAML loader only ever produces plain lists.
+    if type(x) is list:
         return x
     return [x]
 
@@ -146,6 +163,10 @@ def warn(w: str) -> None:
 
 
 def format_error(e, filename) -> str:
+    # Only needed when an error is actually reported, so not imported
+    # at the top.
+    import textwrap
+    import traceback
     lines = [
         "=" * 32 + " Unhandled CWL " + "=" * 32,
         f"  Could not handle CWL file at {filename}",
@@ -159,7 +180,9 @@ def format_error(e, filename) -> str:
         if isinstance(e, UnhandledCwlError):
             lines.append(f"    {e!s}")
         else:
-            lines.append(f"    {traceback.format_exception_only(type(e), e)}")
+            # format_exception_only returns a list of lines; previously
+            # this interpolated the list itself, repr and all.
+            lines.append(textwrap.indent("".join(traceback.format_exception_only(type(e), e)).rstrip(), "    "))
     if getattr(e, "__context__", None) is not None:
         e = e.__context__
         lines.append(f"  caused by the following exception:")
@@ -172,15 +195,30 @@ def error(e, filename) -> None:
     print(crayons.red(format_error(e, filename)))
 
 
-def coloured_diff(diff: Iterable[str]) -> Iterator[str]:
+def colour_affixes(colour) -> Sequence[str]:
+    """Get the (prefix, suffix) escape codes a crayons colour produces."""
     # Crayons' special ColoredString doesn't actually inherit from str,
     # so we have to convert it ourselves.
+    pre, _, post = str(colour("\0")).partition("\0")
+    return pre, post
+
+
+DIFF_REMOVED = colour_affixes(crayons.red)
+DIFF_ADDED = colour_affixes(crayons.green)
+DIFF_HUNK = colour_affixes(crayons.cyan)
+
+
+def coloured_diff(diff: Iterable[str]) -> Iterator[str]:
+    # Concatenating the precomputed escape codes is much cheaper than
+    # building (and stringifying) a ColoredString per line.
     for line in diff:
         if line.startswith("-"):
-            yield str(crayons.red(line))
+            pre, post = DIFF_REMOVED
         elif line.startswith("+"):
-            yield str(crayons.green(line))
+            pre, post = DIFF_ADDED
         elif line.startswith("@"):
-            yield str(crayons.cyan(line))
+            pre, post = DIFF_HUNK
         else:
             yield line
+            continue
+        yield pre + line + post